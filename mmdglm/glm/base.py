@@ -3,7 +3,31 @@ import pickle
 
 import numpy as np
 
-from ..utils import get_dt, shift_array
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+from ..utils import broadcast_trials, get_dt, shifted_spike_times
+
+
+def _sample_kernel(u, eta_kernel, dt, rand, eta_conv, r, mask_spikes):
+    # all arrays have shape (T, K) and are written in place. Trajectories are independent so they run in parallel
+    T, K = u.shape
+    n_eta = len(eta_kernel)
+    for k in prange(K):
+        for j in range(T):
+            u[j, k] += eta_conv[j, k]
+            r[j, k] = np.exp(u[j, k])
+            mask_spikes[j, k] = 1 - np.exp(-r[j, k] * dt) > rand[j, k]
+            if mask_spikes[j, k]:
+                for m in range(j + 1, min(T, j + 1 + n_eta)):
+                    eta_conv[m, k] += eta_kernel[m - j - 1]
+
+
+if njit is not None:
+    _sample_kernel = njit(parallel=True, fastmath=True)(_sample_kernel)
 
 
 class GLM:
@@ -29,7 +53,8 @@ class GLM:
         glm = cls(u0=params['u0'], eta=params['eta'])
         return glm
 
-    def sample(self, t, stim=None, shape=None, full=False):
+    def sample(self, t, stim=None, shape=None, full=False, out=None):
+        # out is an optional tuple of preallocated C-contiguous (u, r, mask_spikes) arrays that are written in place
 
         dt = get_dt(t)
         
@@ -37,38 +62,56 @@ class GLM:
         trials_shape = () if shape is None else shape
         shape = (len(t), ) + stim_shape + trials_shape
             
-        r = np.zeros(shape) * np.nan
+        if out is None:
+            u = np.empty(shape)
+            r = np.full(shape, np.nan)
+            mask_spikes = np.zeros(shape, dtype=bool)
+        else:
+            u, r, mask_spikes = out
         eta_conv = np.zeros(shape)
-        mask_spikes = np.zeros(shape, dtype=bool)
 
         if self.kappa is not None and stim is not None:
             kappa_conv = self.kappa.convolve_continuous(t, stim)
             kappa_conv = np.concatenate((np.zeros((1,) + stim.shape[1:]), kappa_conv[:-1]), axis=0)
-            u = self.u0 + kappa_conv
-            for ii, dim in enumerate(trials_shape):
-                kappa_conv = np.stack([kappa_conv] * dim, ii + stim.ndim)
-                u = np.stack([u] * dim, ii + stim.ndim)
+            kappa_conv = broadcast_trials(kappa_conv, trials_shape)
+            np.add(kappa_conv, self.u0, out=u)
         else:
             kappa_conv = np.zeros(shape)
-            u = np.ones(shape) * self.u0
-
-        j = 0
-        while j < len(t):
+            u[...] = self.u0
 
-            u[j, ...] = u[j, ...] + eta_conv[j, ...]
-            r[j, ...] = np.exp(u[j, ...])
-            p_spk = 1 - np.exp(-r[j, ...] * dt)
-            
-            rand = np.random.rand(*shape[1:])
-            mask_spikes[j, ...] = p_spk > rand
+        eta_kernel = np.zeros(0) if self.eta is None else self.eta.interpolate(t - t[0])
 
-            if self.eta is not None and np.any(mask_spikes[j, ...]) and j < len(t) - 1:
-                eta_conv[j + 1:, mask_spikes[j, ...]] += self.eta.interpolate(t[j + 1:] - t[j + 1])[:, None]
-
-            j += 1
+        if njit is not None:
+            # uniforms are drawn in the same order as the numpy loop so both give the same samples for a seed
+            rand = np.random.rand(*shape)
+            _sample_kernel(u.reshape(len(t), -1), eta_kernel, dt, rand.reshape(len(t), -1), 
+                           eta_conv.reshape(len(t), -1), r.reshape(len(t), -1), mask_spikes.reshape(len(t), -1))
+        else:
+            # within a block the history is updated spike by spike only up to the block end. The tail after the 
+            # block is added at once as the product of the Toeplitz matrix of eta_kernel and the block spikes
+            block = 32
+            for j0 in range(0, len(t), block):
+                j1 = min(j0 + block, len(t))
+                for j in range(j0, j1):
+
+                    u[j, ...] = u[j, ...] + eta_conv[j, ...]
+                    r[j, ...] = np.exp(u[j, ...])
+                    p_spk = 1 - np.exp(-r[j, ...] * dt)
+
+                    rand = np.random.rand(*shape[1:])
+                    mask_spikes[j, ...] = p_spk > rand
+
+                    if self.eta is not None and np.any(mask_spikes[j, ...]) and j < j1 - 1:
+                        eta_conv[j + 1:j1, mask_spikes[j, ...]] += eta_kernel[:j1 - j - 1, None]
+
+                if self.eta is not None and np.any(mask_spikes[j0:j1, ...]) and j1 < len(t):
+                    lags = np.arange(j1, len(t))[:, None] - np.arange(j0, j1)[None, :] - 1
+                    eta_conv[j1:, ...] += np.tensordot(eta_kernel[lags], mask_spikes[j0:j1, ...].astype(float), 
+                                                       axes=(1, 0))
         
         if full:
-            return kappa_conv, eta_conv, u, r, mask_spikes
+            # kappa_conv is a read-only view broadcast over trials so a writable copy is returned
+            return kappa_conv.copy(), eta_conv, u, r, mask_spikes
         else:
             return u, r, mask_spikes
 
@@ -76,19 +119,16 @@ class GLM:
 
         shape = mask_spikes.shape
         dt = get_dt(t)
-        arg_spikes = np.where(shift_array(mask_spikes, 1, fill_value=False))
-        t_spikes = (t[arg_spikes[0]],) + arg_spikes[1:]
+        t_spikes = shifted_spike_times(t, mask_spikes)
         
         if self.kappa is not None and stim is not None:
             assert shape[:stim.ndim] == stim.shape
             kappa_conv = np.concatenate((np.zeros((1,) + stim.shape[1:]), self.kappa.convolve_continuous(t, stim)[:-1]), axis=0)
+            kappa_conv = broadcast_trials(kappa_conv, shape[stim.ndim:])
             u = kappa_conv + self.u0
-            for ii, dim in enumerate(shape[stim.ndim:]):
-                kappa_conv = np.stack([kappa_conv] * dim, ii + stim.ndim)
-                u = np.stack([u] * dim, ii + stim.ndim)
         else:
             kappa_conv = np.zeros(shape)
-            u = np.ones(shape) * self.u0
+            u = np.full(shape, self.u0, dtype=float)
             
         if self.eta is not None and len(t_spikes[0]) > 0:
             eta_conv = self.eta.convolve_discrete(t, t_spikes, shape=shape[1:]) #TODO. check if 1: or not
@@ -99,7 +139,8 @@ class GLM:
         r = np.exp(u)
 
         if full:
-            return kappa_conv, eta_conv, u, r
+            # kappa_conv is a read-only view broadcast over trials so a writable copy is returned
+            return kappa_conv.copy(), eta_conv, u, r
         else:
             return u, r
     
@@ -134,14 +175,10 @@ class GLM:
         if self.kappa is not None and stim is not None:
             n_kappa = self.kappa.nbasis
             X_kappa = self.kappa.convolve_basis_continuous(t, stim)
-            X_kappa = np.concatenate((np.zeros((1,) + X_kappa.shape[1:]), X_kappa[:-1]), axis=0)
-            for ii, dim in enumerate(mask_spikes.shape[stim.ndim:]):
-                X_kappa = np.stack([X_kappa] * dim, ii + stim.ndim)
-            X[..., 1:1 + n_kappa] = X_kappa
+            X[1:, ..., 1:1 + n_kappa] = broadcast_trials(X_kappa[:-1], mask_spikes.shape[stim.ndim:], n_trailing=1)
         
         if self.eta is not None:
-            args = np.where(shift_array(mask_spikes, 1, fill_value=False))
-            t_spk = (t[args[0]],) + args[1:]
+            t_spk = shifted_spike_times(t, mask_spikes)
             n_eta = self.eta.nbasis
             X_eta = self.eta.convolve_basis_discrete(t, t_spk, shape=mask_spikes.shape)
             X[..., 1 + n_kappa:] = X_eta
@@ -2,14 +2,27 @@ import numpy as np
 import torch
 
 from .base import GLM
-from ..utils import get_dt, shift_array
+from ..utils import get_dt, shifted_spike_times
+
+
+def _mean_off_diagonal(gramian):
+    n = gramian.shape[0]
+    return (torch.sum(gramian) - torch.sum(torch.diagonal(gramian))) / (n * (n - 1))
+
+
+def _neg_log_likelihood(dt, mask_spikes, u):
+    r = torch.exp(u.double())
+    # the log is only evaluated on spike bins so that r underflowing to 0 elsewhere doesn't give nan gradients
+    r_spk = torch.where(mask_spikes, r, torch.ones_like(r))
+    return -torch.sum(torch.where(mask_spikes, torch.log(-torch.expm1(-dt * r_spk)), -dt * r))
 
 
 class MBMMDGLM(GLM, torch.nn.Module):
 
-    def __init__(self, u0=0, kappa=None, eta=None, non_linearity='exp'):
+    def __init__(self, u0=0, kappa=None, eta=None, non_linearity='exp', dtype=torch.float32):
         torch.nn.Module.__init__(self)
         GLM.__init__(self, u0=u0, kappa=kappa, eta=eta, non_linearity=non_linearity)
+        self.dtype = dtype
         
         n_kappa = 0 if self.kappa is None else self.kappa.nbasis
         n_eta = 0 if self.eta is None else self.eta.nbasis
@@ -24,62 +37,93 @@ class MBMMDGLM(GLM, torch.nn.Module):
             eta_coefs = torch.from_numpy(eta.coefs)
             self.register_parameter("eta_coefs", torch.nn.Parameter(eta_coefs))
             
-    def forward(self, t, stim=None, n_batch_fr=None):
+    def forward(self, t, stim=None, n_batch_fr=None, out_X=None, out_sample=None, X_const=None):
+        # out_X and out_sample are optional preallocated buffers for the design matrix and for the (u, r, mask_spikes)
+        # arrays of sample. The returned X_fr and mask_spikes_fr share memory with them
         
         dt = get_dt(t)
         theta_g = self.get_params()
+        n_kappa = 0 if self.kappa is None else self.kappa.nbasis
+        n_eta = 0 if self.eta is None else self.eta.nbasis
         
         if stim is not None:
-            _, _, mask_spikes_fr = self.sample(t, stim=stim)
+            _, _, mask_spikes_fr = self.sample(t, stim=stim, out=out_sample)
         else:
-            _, _, mask_spikes_fr = self.sample(t, shape=(n_batch_fr,))
+            _, _, mask_spikes_fr = self.sample(t, shape=(n_batch_fr,), out=out_sample)
 
-        X_fr = torch.from_numpy(self.objective_kwargs(t, mask_spikes_fr, stim=stim)['X'])
-        u_fr = torch.einsum('tka,a->tk', X_fr, theta_g)
+        if out_X is None:
+            X_fr = torch.empty(mask_spikes_fr.shape + (1 + n_kappa + n_eta,), dtype=self.dtype)
+        else:
+            X_fr = out_X
+        X_const = self._get_X_const(t, stim) if X_const is None else X_const
+        X_fr[..., :1 + n_kappa].copy_(X_const.reshape(X_const.shape[:-1] + (1,) * (mask_spikes_fr.ndim + 1 - X_const.ndim) + 
+                                                      X_const.shape[-1:]))
+        if self.eta is not None:
+            t_spk = shifted_spike_times(t, mask_spikes_fr)
+            X_eta = self.eta.convolve_basis_discrete(t, t_spk, shape=mask_spikes_fr.shape)
+            X_fr[..., 1 + n_kappa:] = torch.from_numpy(X_eta)
+        
+        # sampling runs on the cpu so the sampled spikes are moved to the device of the parameters
+        X_fr = X_fr.to(theta_g.device, non_blocking=True)
+        u_fr = X_fr @ theta_g.to(X_fr.dtype)
         r_fr = torch.exp(u_fr)
-        mask_spikes_fr = torch.from_numpy(mask_spikes_fr)
+        mask_spikes_fr = torch.from_numpy(mask_spikes_fr).to(theta_g.device, non_blocking=True)
         
         return r_fr, mask_spikes_fr, X_fr
     
-    def get_params(self):
+    def _get_X_const(self, t, stim):
+        # constant and stimulus columns of the design matrix. They only depend on t and stim so train builds them 
+        # once and passes them to forward on every epoch
         n_kappa = 0 if self.kappa is None else self.kappa.nbasis
-        n_eta = 0 if self.eta is None else self.eta.nbasis
-        theta = torch.zeros(1 + n_kappa + n_eta)
-        theta[0] = self.b
+        stim_shape = () if stim is None else stim.shape[1:]
+        X_const = np.zeros((len(t),) + stim_shape + (1 + n_kappa,))
+        X_const[..., 0] = 1
+        if self.kappa is not None and stim is not None:
+            X_const[1:, ..., 1:] = self.kappa.convolve_basis_continuous(t, stim)[:-1]
+        return torch.from_numpy(X_const)
+    
+    def get_params(self):
+        theta = [self.b]
         if self.kappa is not None:
-            theta[1:1 + n_kappa] = self.kappa_coefs
+            theta.append(self.kappa_coefs)
         if self.eta is not None:
-            theta[1 + n_kappa:] = self.eta_coefs
-        theta = theta.double()
+            theta.append(self.eta_coefs)
+        theta = torch.cat(theta)
         return theta
     
     def _log_likelihood(self, dt, mask_spikes, X_dc):
         theta_g = self.get_params()
-        u_dc = torch.einsum('tka,a->tk', X_dc, theta_g)
-        r_dc = torch.exp(u_dc)
-        neg_log_likelihood = -(torch.sum(torch.log(1 - torch.exp(-dt * r_dc) + 1e-24) * mask_spikes.double()) - \
-                               dt * torch.sum(r_dc * (1 - mask_spikes.double())))
-        return neg_log_likelihood
+        u_dc = X_dc @ theta_g.to(X_dc.dtype)
+        return _neg_log_likelihood(dt, torch.as_tensor(mask_spikes).bool(), u_dc)
     
     def train(self, t, mask_spikes, phi=None, kernel=None, stim=None, log_likelihood=False, lam_mmd=1e0, biased=False, 
               optim=None, clip=None, num_epochs=20, n_batch_fr=100, kernel_kwargs=None, verbose=False, metrics=None, 
-              n_metrics=25):
+              n_metrics=25, device=None):
 
         n_d = mask_spikes.shape[1]
+        
+        if device is not None:
+            self.to(device)
+        device = self.b.device
     
-        dt = torch.tensor([get_dt(t)])
+        dt = torch.tensor([get_dt(t)], device=device)
         loss, nll = [], []
         
-        X_dc = torch.from_numpy(self.objective_kwargs(t, mask_spikes, stim=stim)['X']).double()
+        X_dc = torch.from_numpy(self.objective_kwargs(t, mask_spikes, stim=stim)['X']).to(device, self.dtype)
+        mask_spikes_dc = torch.as_tensor(mask_spikes).to(device).bool()
         
         kernel_kwargs = kernel_kwargs if kernel_kwargs is not None else {}
         
-        if phi is None:
-            idx_fr = np.triu_indices(n_batch_fr, k=1)
-            idx_fr = (torch.from_numpy(idx_fr[0]), torch.from_numpy(idx_fr[1]))
-            idx_d = np.triu_indices(n_d, k=1)
-            idx_d = (torch.from_numpy(idx_d[0]), torch.from_numpy(idx_d[1]))
-                
+        n_kappa = 0 if self.kappa is None else self.kappa.nbasis
+        n_eta = 0 if self.eta is None else self.eta.nbasis
+        shape_fr = (len(t),) + (stim.shape[1:] if stim is not None else (n_batch_fr,))
+        # pinned host buffers allow asynchronous copies of the sampled spikes to the gpu
+        pin_memory = device.type == 'cuda'
+        X_fr_buf = torch.empty(shape_fr + (1 + n_kappa + n_eta,), dtype=self.dtype, pin_memory=pin_memory)
+        mask_spikes_fr_buf = torch.empty(shape_fr, dtype=torch.bool, pin_memory=pin_memory)
+        sample_buf = (np.empty(shape_fr), np.empty(shape_fr), mask_spikes_fr_buf.numpy())
+        X_const = self._get_X_const(t, stim)
+        
         _loss = torch.tensor([np.nan])
 
         for epoch in range(num_epochs):
@@ -90,10 +134,11 @@ class MBMMDGLM(GLM, torch.nn.Module):
             optim.zero_grad()
             
             theta_g = self.get_params()
-            u_dc = torch.einsum('tka,a->tk', X_dc, theta_g)
+            u_dc = X_dc @ theta_g.to(X_dc.dtype)
             r_dc = torch.exp(u_dc)
             
-            r_fr, mask_spikes_fr, X_fr = self(t, stim=stim, n_batch_fr=n_batch_fr)
+            r_fr, mask_spikes_fr, X_fr = self(t, stim=stim, n_batch_fr=n_batch_fr, out_X=X_fr_buf, 
+                                              out_sample=sample_buf, X_const=X_const)
 
             if phi is not None:
                 phi_d = phi(t, r_dc, model=self, **kernel_kwargs)
@@ -115,7 +160,7 @@ class MBMMDGLM(GLM, torch.nn.Module):
                 gramian_fr_fr = kernel(t, r_fr, r_fr, model=self)
                 gramian_d_fr = kernel(t, r_dc, r_fr, model=self)
                 if not biased:
-                    mmd_grad = torch.mean(gramian_d_d[idx_d]) + torch.mean(gramian_fr_fr[idx_fr]) \
+                    mmd_grad = _mean_off_diagonal(gramian_d_d) + _mean_off_diagonal(gramian_fr_fr) \
                                 -2 * torch.mean(gramian_d_fr)
                 else:
                     mmd_grad = torch.mean(gramian_d_d) + torch.mean(gramian_fr_fr) \
@@ -124,7 +169,7 @@ class MBMMDGLM(GLM, torch.nn.Module):
             _loss = lam_mmd * mmd_grad
             
             if log_likelihood:
-                _nll = self._log_likelihood(dt, mask_spikes, X_dc)
+                _nll = _neg_log_likelihood(dt, mask_spikes_dc, u_dc)
                 nll.append(_nll.item())
                 _loss = _loss + _nll
 
@@ -134,12 +179,13 @@ class MBMMDGLM(GLM, torch.nn.Module):
                 
             if (epoch % n_metrics) == 0:
                 
-                _metrics = metrics(self, t, mask_spikes, mask_spikes_fr) if metrics is not None else {}
+                # mask_spikes_fr is overwritten on the next epoch so metrics get a copy
+                _metrics = metrics(self, t, mask_spikes, mask_spikes_fr.clone()) if metrics is not None else {}
 
                 if phi is not None:
                     _metrics['mmd'] = (torch.sum((torch.mean(phi_d.detach(), 1) - torch.mean(phi_fr.detach(), 1))**2)).item()
                 else:
-                    _metrics['mmd'] = torch.mean(gramian_d_d.detach()[idx_d]) + torch.mean(gramian_fr_fr.detach()[idx_fr]) \
+                    _metrics['mmd'] = _mean_off_diagonal(gramian_d_d.detach()) + _mean_off_diagonal(gramian_fr_fr.detach()) \
                                       - 2 * torch.mean(gramian_d_fr.detach())
                 
                 if epoch == 0:
@@ -151,7 +197,7 @@ class MBMMDGLM(GLM, torch.nn.Module):
             optim.step()
             
             theta_g = self.get_params()
-            self.set_params(theta_g.data.detach().numpy())
+            self.set_params(theta_g.data.detach().cpu().numpy())
             
             loss.append(_loss.item())
             
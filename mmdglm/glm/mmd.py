@@ -6,7 +6,7 @@ from sptr.sptr import SpikeTrain
 
 from .base import GLM
 from ..metrics import _mmd_from_features, _mmd_from_gramians
-from ..utils import get_dt, shift_array
+from ..utils import get_dt
 
 
 class MMDGLM(GLM, torch.nn.Module):
@@ -40,27 +40,24 @@ class MMDGLM(GLM, torch.nn.Module):
             _, _, mask_spikes_fr = self.sample(t, shape=(n_batch_fr,))
 
         X_fr = torch.from_numpy(self.objective_kwargs(t, mask_spikes_fr, stim=stim)['X'])
-        u_fr = torch.einsum('tka,a->tk', X_fr, theta_g)
+        u_fr = X_fr @ theta_g
         r_fr = torch.exp(u_fr)
         mask_spikes_fr = torch.from_numpy(mask_spikes_fr)
         
         return r_fr, mask_spikes_fr, X_fr
     
     def get_params(self):
-        n_kappa = 0 if self.kappa is None else self.kappa.nbasis
-        n_eta = 0 if self.eta is None else self.eta.nbasis
-        theta = torch.zeros(1 + n_kappa + n_eta)
-        theta[0] = self.b
+        theta = [self.b]
         if self.kappa is not None:
-            theta[1:1 + n_kappa] = self.kappa_coefs
+            theta.append(self.kappa_coefs)
         if self.eta is not None:
-            theta[1 + n_kappa:] = self.eta_coefs
-        theta = theta.double()
+            theta.append(self.eta_coefs)
+        theta = torch.cat(theta).double()
         return theta
     
     def _neg_log_likelihood(self, dt, mask_spikes, X_dc):
         theta_g = self.get_params()
-        u_dc = torch.einsum('tka,a->tk', X_dc, theta_g)
+        u_dc = X_dc @ theta_g
         r_dc = torch.exp(u_dc)
         neg_log_likelihood = -(torch.sum(torch.log(1 - torch.exp(-dt * r_dc)) * mask_spikes.double()) - \
                                dt * torch.sum(r_dc * (1 - mask_spikes.double())))
@@ -69,11 +66,11 @@ class MMDGLM(GLM, torch.nn.Module):
     def _score(self, dt, mask_spikes, X):
         with torch.no_grad():
             theta_g = self.get_params().detach()
-            u = torch.einsum('tka,a->tk', X, theta_g)
+            u = X @ theta_g
             r = torch.exp(u)
             exp_r = torch.exp(r * dt)
-            score = dt * torch.einsum('tka,tk->ka', X, r / (exp_r - 1) * mask_spikes.double()) - \
-                    dt * torch.einsum('tka,tk->ka', X, r * (1 - mask_spikes.double()))
+            w = torch.where(mask_spikes, r / (exp_r - 1), -r)
+            score = dt * torch.einsum('tka,tk->ka', X, w)
         return score
     
     def train(self, t, mask_spikes, phi=None, kernel=None, stim=None, log_likelihood=False, lam_mmd=1e0, biased=False, 
@@ -6,10 +6,11 @@ from ..utils import get_dt
 
 class TorchGLM(GLM, torch.nn.Module):
 
-    def __init__(self, u0=0, kappa=None, eta=None, non_linearity='exp', noise='poisson'):
+    def __init__(self, u0=0, kappa=None, eta=None, non_linearity='exp', noise='poisson', dtype=torch.float32):
         torch.nn.Module.__init__(self)
         GLM.__init__(self, u0=u0, kappa=kappa, eta=eta, non_linearity=non_linearity)
         self.noise = noise
+        self.dtype = dtype
         
         n_kappa = 0 if self.kappa is None else self.kappa.nbasis
         n_eta = 0 if self.eta is None else self.eta.nbasis
@@ -29,24 +30,23 @@ class TorchGLM(GLM, torch.nn.Module):
         
         theta = self.get_params()
         
-        u = torch.einsum('tka,a->tk', X, theta)
-        r = torch.exp(u)
+        u = X @ theta.to(X.dtype)
+        r = torch.exp(u.double())
         
-        nll = -(torch.sum(torch.log(1 - torch.exp(-dt * r[mask_spikes]) + 1e-24) ) - \
-                dt * torch.sum(r[~mask_spikes]))    
+        # the log is only evaluated on spike bins so that r underflowing to 0 elsewhere doesn't give nan gradients
+        mask_spikes = torch.as_tensor(mask_spikes).bool()
+        r_spk = torch.where(mask_spikes, r, torch.ones_like(r))
+        nll = -torch.sum(torch.where(mask_spikes, torch.log(-torch.expm1(-dt * r_spk)), -dt * r))
             
         return nll
     
     def get_params(self):
-        n_kappa = 0 if self.kappa is None else self.kappa.nbasis
-        n_eta = 0 if self.eta is None else self.eta.nbasis
-        theta = torch.zeros(1 + n_kappa + n_eta)
-        theta[0] = self.b
+        theta = [self.b]
         if self.kappa is not None:
-            theta[1:1 + n_kappa] = self.kappa_coefs
+            theta.append(self.kappa_coefs)
         if self.eta is not None:
-            theta[1 + n_kappa:] = self.eta_coefs
-        theta = theta.double()
+            theta.append(self.eta_coefs)
+        theta = torch.cat(theta)
         return theta
 
     def train(self, t, mask_spikes, stim=None, optim=None, num_epochs=20, verbose=False, metrics=None, 
@@ -56,7 +56,9 @@ class TorchGLM(GLM, torch.nn.Module):
         loss, metrics_list = [], []
         metrics_kwargs = metrics_kwargs if metrics_kwargs is not None else {}
         
-        X = torch.from_numpy(self.objective_kwargs(t, mask_spikes, stim=stim)['X']).double()
+        # metrics get the float64 design matrix, the same dtype as get_params
+        X_metrics = torch.from_numpy(self.objective_kwargs(t, mask_spikes, stim=stim)['X'])
+        X = X_metrics.to(self.dtype)
         
         _loss = torch.tensor(float('nan'))
         
@@ -75,7 +77,7 @@ class TorchGLM(GLM, torch.nn.Module):
                 _loss = _nll
             
             if (epoch % n_metrics) == 0:
-                _metrics = metrics(self, t, mask_spikes, X, **metrics_kwargs) if metrics is not None else {}
+                _metrics = metrics(self, t, mask_spikes, X_metrics, **metrics_kwargs) if metrics is not None else {}
 
                 if l2:
                     _metrics['nll'] = _nll.detach()
@@ -17,8 +17,21 @@ def phi_autocor_history(t, r, model, padding=250):
     return autocov
 
 
+def _sq_distances(x1, x2):
+    # pairwise squared distances between the columns of x1 and x2 as |x1|^2 + |x2|^2 - 2 x1.x2 with a single matmul.
+    # computed in float64 since the expansion cancels badly in float32
+    x1, x2 = x1.double(), x2.double()
+    sq_dist = torch.sum(x1**2, 0)[:, None] + torch.sum(x2**2, 0)[None, :] - 2 * x1.T @ x2
+    return torch.clamp(sq_dist, min=0)
+
+
 def ker_schoenberg(t, mask_spikes1, mask_spikes2, sd2=1e0):
     cum1 = torch.cumsum(mask_spikes1, dim=0)
     cum2 = torch.cumsum(mask_spikes2, dim=0)
-    gramian = torch.exp(-torch.sum((cum1[:, :, None] - cum2[:, None, :])**2, dim=0) / sd2)
+    gramian = torch.exp(-_sq_distances(cum1, cum2) / sd2)
+    return gramian
+
+
+def ker_gaussian(t, r1, r2, model=None, sd2=1e0):
+    gramian = torch.exp(-_sq_distances(r1, r2) / sd2)
     return gramian
@@ -1,6 +1,17 @@
 import numpy as np
 
 
+def broadcast_trials(arr, trials_shape, n_trailing=0):
+    """
+    Broadcasts arr over trials_shape without copying. The trial dimensions are
+    inserted before the last n_trailing dimensions of arr. Returns a read-only view
+    """
+    trials_shape = tuple(trials_shape)
+    lead, trail = arr.shape[:arr.ndim - n_trailing], arr.shape[arr.ndim - n_trailing:]
+    arr = arr.reshape(lead + (1,) * len(trials_shape) + trail)
+    return np.broadcast_to(arr, lead + trials_shape + trail)
+
+
 def get_dt(t):
     arg_dt = 20 if len(t) >= 20 else len(t)
     dt = np.median(np.diff(t[:arg_dt]))
@@ -38,19 +49,11 @@ def searchsorted(t, s, side='left'):
     return arg
 
 
-def shift_array(arr, shift, fill_value=False):
+def shifted_spike_times(t, mask_spikes):
     """
-    Shifts array on axis 0 filling the shifted values with fill_value
-    Positive shift is to the right, negative to the left
+    Returns the spikes of mask_spikes shifted one bin to the right as a tuple
+    (times, *trial indices). Spikes in the last bin are dropped
     """
-
-    result = np.empty_like(arr)
-    if shift > 0:
-        result[:shift, ...] = fill_value
-        result[shift:, ...] = arr[:-shift, ...]
-    elif shift < 0:
-        result[shift:, ...] = fill_value
-        result[:shift, ...] = arr[-shift:, ...]
-    else:
-        result = arr
-    return result
+    args = np.where(mask_spikes)
+    keep = args[0] < len(t) - 1
+    return (t[args[0][keep] + 1],) + tuple(arg[keep] for arg in args[1:])